@@ -6,15 +6,78 @@ port.
 
 You should not need to make any changes in this file.
 """
+import logging
+import os
+import selectors
+import socket
 import sys
 
 from server import Server
 
+# Show the server starting and stopping; per-turn tracing is at DEBUG
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
 try:
     PORT = int(sys.argv[1])
 except IndexError:
     print("Please include a port number, eg: python serve.py 50000")
     exit(-1)
 
+# Optionally play fake turns before serving, so the interpreter has
+# specialized the per-turn code by the time the first client arrives.
+# WARMUP may be a number of turns, or yes/true/on for the default count.
+WARMUP = os.environ.get('WARMUP', '').strip().lower()
+if WARMUP in ('', 'no', 'false', 'off'):
+    WARMUP_TURNS = 0
+elif WARMUP in ('yes', 'true', 'on'):
+    WARMUP_TURNS = 2000
+else:
+    try:
+        WARMUP_TURNS = int(WARMUP)
+    except ValueError:
+        print("WARMUP must be a number of turns or yes/no, eg: WARMUP=2000")
+        exit(-1)
+
+WARMUP_COMMANDS = ('move north', 'say Hello?', 'move south', 'move west',
+                   'move west', 'move east', 'dance', 'quit')
+
+
+def warm_up(turns):
+    """
+    Plays `turns` fake turns, each through a session's whole receive, route
+    and send path over a socket pair; every 'quit' ends that session and the
+    next turn starts a new one.
+    """
+    selector = selectors.DefaultSelector()
+    session = player = None
+
+    for turn in range(turns):
+        if session is None:
+            connection, player = socket.socketpair()
+            connection.setblocking(False)
+            session = Server(PORT)
+            session.client_connection = connection
+            session.selector = selector
+            session.start()
+            player.recv(4096)
+
+        command = WARMUP_COMMANDS[turn % len(WARMUP_COMMANDS)]
+        player.sendall(command.encode('utf-8') + b'\n')
+        session.handle_events(selectors.EVENT_READ)
+        player.recv(4096)
+
+        if session.done:
+            player.close()
+            session = player = None
+
+    if session is not None:
+        session.close()
+        player.close()
+    selector.close()
+
+
+if WARMUP_TURNS > 0:
+    warm_up(WARMUP_TURNS)
+
 SERVER = Server(PORT)
 SERVER.serve()
@@ -1,8 +1,30 @@
 """
 A simple message server / client using socket
 """
+import errno
+import logging
+import selectors
 import socket
 
+log = logging.getLogger('server')
+
+# accept() errors that mean the process is out of descriptors or memory: they
+# persist until a session is closed, rather than belonging to one client
+_ACCEPT_EXHAUSTED = frozenset(
+    (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM))
+
+# The room reached by moving in each direction, at _EXITS[room << 2 | dir];
+# _NO_EXIT where there is no way through
+_DIRECTIONS = {'west': 0, 'east': 1, 'north': 2, 'south': 3}
+_NO_EXIT = 0xFF
+_EXITS = bytes((
+    # west     east      north     south
+    1,         2,        3,        _NO_EXIT,    # room 0
+    _NO_EXIT,  0,        _NO_EXIT, _NO_EXIT,    # room 1
+    0,         _NO_EXIT, _NO_EXIT, _NO_EXIT,    # room 2
+    _NO_EXIT,  _NO_EXIT, _NO_EXIT, 0,           # room 3
+))
+
 
 class Server():
     """
@@ -10,14 +32,30 @@ class Server():
 
     An instance's methods share the following variables:
 
-    * self.socket: a "bound" server socket, as produced by socket.bind()
+    * self.socket: a "bound" server socket, as produced by socket.bind().
+      Only the instance running `serve` has one; it accepts connections and
+      hands each to a new instance of its own (see `accept`).
+    * self.selector: the selectors.BaseSelector that `serve` waits on, shared
+      by every instance so each can register its own connection.
+    * self.listener: the instance running `serve`, for each client's instance;
+      told when a client leaves, in case it has stopped accepting new ones.
     * self.client_connection: a "connection" socket as produced by
       socket.accept()
+    * self.recv_buffer: a bytearray that client_connection receives into,
+      reused for the whole session. Its first self.recv_length bytes have
+      been received but not yet consumed as a line; self.recv_view is a
+      memoryview of it, and the first self.recv_scanned bytes are known to
+      hold no newline.
     * self.input_buffer: a string that has been read from the connected client
       and has yet to be acted upon.
     * self.output_buffer: a string that should be sent to the connected client;
       for testing purposes this string should NOT end in a newline character.
       When writing to the output_buffer, DON'T concatenate: just overwrite.
+    * self.output_bytes: the encoded message to send for output_buffer, when
+      it is one of the static replies precomputed below; otherwise None and
+      push_output formats and encodes output_buffer itself.
+    * self.pending_output: encoded replies queued by push_output that have not
+      yet been written to client_connection (see `flush_output`).
     * self.done: A boolean, False until the client is ready to disconnect
     * self.room: one of 0, 1, 2, 3. This signifies which "room" the client is
       in, according to the following map:
@@ -46,15 +84,68 @@ class Server():
     you'll be free to develop any room descriptions you like: the only
     requirement is that each room have a unique description.
     """
+    # One instance exists per connected client, so keep each one small: no
+    # per-instance __dict__, just these attributes
+    __slots__ = (
+        'input_buffer', 'output_buffer', 'output_bytes', 'pending_output',
+        'done', 'socket', 'client_connection', 'recv_buffer', 'recv_view',
+        'recv_length', 'recv_scanned', 'recv_short_lines', 'selector',
+        'listener', 'port', 'room'
+    )
+
     game_name = "Realms of Venture"
+    # SO_SNDBUF / SO_RCVBUF for each connection; None leaves the kernel to
+    # autotune them, which suits replies of a few hundred bytes
+    socket_buffer_size = None
+    # Receive buffer capacity; it grows to fit longer lines, up to
+    # recv_max_line bytes, and shrinks back once recv_shrink_after lines in a
+    # row fit in recv_shrink_below bytes
+    recv_size = 8192
+    recv_max_line = 64 * 1024
+    recv_shrink_below = 1024
+    recv_shrink_after = 16
+    # Flush queued replies once this many are waiting, even without a read
+    max_pending_output = 64
+
+    _ROOMS = (
+        "Happy rabbits hop contentedly in the center of the room"
+        " whose walls are a verdant green with large windows"
+        " looking out into a garden patio.",
+        "A dark pit of despair swirls red and black embers in"
+        " the center of a room painted with the dripping sorrow"
+        " of a thousand unfortunate souls.",
+        "Arthur Dent stands forlornly in the room in his pajamas"
+        " and bunny slippers holding a towel for some reason as"
+        " a large, low rumble of construction machinery is rapidly"
+        " becoming louder",
+        "The communal room of Seitch Tabr stretches out before you"
+        " high walls of lazgun carved caves. Stilgar approaches"
+        " and hands you your thumper and worm hooks."
+    )
+
+    # The encoded "OK!" replies that never change: one per room, and goodbye
+    _ROOM_BYTES = tuple(
+        ("\nOK! " + room + "\n").encode('utf-8') for room in _ROOMS
+    )
+    _GOODBYE = b"\nOK! Goodbye!\n"
+    _BAD_MOVE = b"\nOK! Oops! You can't go that way\n"
 
     def __init__(self, port=50000):
         """ Initialize the server """
         self.input_buffer = ""
         self.output_buffer = ""
+        self.output_bytes = None
+        self.pending_output = []
         self.done = False
         self.socket = None
         self.client_connection = None
+        self.recv_buffer = bytearray(self.recv_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.recv_length = 0
+        self.recv_scanned = 0
+        self.recv_short_lines = 0
+        self.selector = None
+        self.listener = None
         self.port = port
         self.room = 0
 
@@ -65,12 +156,47 @@ class Server():
             socket.SOCK_STREAM,
             socket.IPPROTO_TCP)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Every reply is a small, complete message: don't let Nagle hold it
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         address = ('127.0.0.1', self.port)
         self.socket.bind(address)
-        self.socket.listen(1)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+
+        log.info("Starting Server")
 
-        print("Starting Server")
-        self.client_connection, address = self.socket.accept()
+    def accept(self):
+        """
+        Accept the next client waiting to connect. Raises BlockingIOError if
+        there is none.
+
+        Each client plays in its own instance, so that their rooms and buffers
+        are independent of every other client's.
+
+        :return: Server, ready to `start` the game with the new client
+        """
+        connection, address = self.socket.accept()
+        try:
+            connection.setblocking(False)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.socket_buffer_size is not None:
+                # The kernel caps these at net.core.wmem_max / rmem_max
+                connection.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_SNDBUF,
+                    self.socket_buffer_size)
+                connection.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_RCVBUF,
+                    self.socket_buffer_size)
+
+        except OSError:
+            connection.close()
+            raise
+
+        session = type(self)(self.port)
+        session.client_connection = connection
+        session.selector = self.selector
+        session.listener = self
+        return session
 
     @staticmethod
     def room_description(room_number):
@@ -84,21 +210,7 @@ class Server():
         :param room_number: int
         :return: str
         """
-        return {
-            0: "Happy rabbits hop contentedly in the center of the room"
-               " whose walls are a verdant green with large windows"
-               " looking out into a garden patio.",
-            1: "A dark pit of despair swirls red and black embers in"
-               " the center of a room painted with the dripping sorrow"
-               " of a thousand unfortunate souls.",
-            2: "Arthur Dent stands forlornly in the room in his pajamas"
-               " and bunny slippers holding a towel for some reason as"
-               " a large, low rumble of construction machinery is rapidly"
-               " becoming louder",
-            3: "The communal room of Seitch Tabr stretches out before you"
-               " high walls of lazgun carved caves. Stilgar approaches"
-               " and hands you your thumper and worm hooks."
-            }[room_number]
+        return Server._ROOMS[room_number]
 
     def greet(self):
         """
@@ -114,28 +226,111 @@ class Server():
             self.room_description(self.room)
         )
 
+    def receive(self):
+        """
+        Reads everything the client has sent so far into self.recv_buffer,
+        without blocking.
+
+        A line longer than recv_max_line is refused: an error reply is queued
+        and the connection is treated as closed.
+
+        :return: bool, False once the client has closed the connection
+        """
+        while True:
+            if self.recv_length == len(self.recv_buffer):
+                # Full: handle the lines already in hand before growing, the
+                # selector reports the rest of the data again afterwards
+                if self.recv_buffer.find(
+                        b'\n', self.recv_scanned, self.recv_length) >= 0:
+                    return True
+
+                if self.recv_length >= self.recv_max_line:
+                    # Refuse to buffer an endless line: tell the client why
+                    # and end the session as though they had hung up
+                    log.debug('client line exceeded %s bytes',
+                              self.recv_max_line)
+                    self.invalid_command('line too long')
+                    self.push_output()
+                    return False
+
+                self._resize_recv_buffer(
+                    min(2 * len(self.recv_buffer), self.recv_max_line))
+
+            try:
+                received = self.client_connection.recv_into(
+                    self.recv_view[self.recv_length:])
+            except BlockingIOError:
+                return True
+
+            if not received:
+                log.debug('client closed the connection')
+                return False
+
+            self.recv_length += received
+
     def get_input(self):
         """
         Retrieve input from the client_connection. All messages from the client
-        should end in a newline character: '\n'.
+        should end in a newline character: '\n'. The line is put into
+        self.input_buffer without its line ending.
 
-        This is a BLOCKING call. It should not return until there is some input
-        from the client to receive.
+        Only data that `receive` has already read is examined, so this never
+        blocks.
 
-        :return: None
+        :return: bool, True if a complete line was put into self.input_buffer
         """
-        print('Awaiting input...')
-        data_chunk = 16
+        newline = self.recv_buffer.find(
+            b'\n', self.recv_scanned, self.recv_length)
+
+        if newline < 0:
+            # Nothing more to do until the client sends the rest of the line
+            self.recv_scanned = self.recv_length
+            log.debug('Awaiting input...')
+            return False
+
+        # Decode only whole lines; anything after the newline is moved to the
+        # front for the next call, so commands sent together aren't lost
+        end = newline + 1
+
+        # Trim the line ending (including a telnet-style '\r') and trailing
+        # blanks on the raw bytes, so no stripped copy of the str is needed
+        line_end = newline
+        while line_end and self.recv_buffer[line_end - 1] in b' \t\r':
+            line_end -= 1
+
+        self.input_buffer = str(
+            self.recv_view[:line_end], 'utf-8', 'replace')
+        remaining = self.recv_length - end
+        self.recv_view[:remaining] = self.recv_view[end:self.recv_length]
+        self.recv_length = remaining
+        self.recv_scanned = 0
+
+        if len(self.recv_buffer) > self.recv_size:
+            if end < self.recv_shrink_below:
+                self.recv_short_lines += 1
+            else:
+                self.recv_short_lines = 0
 
-        try:
-            self.input_buffer = ''
-            while "\n" not in self.input_buffer:
-                self.input_buffer += \
-                    self.client_connection.recv(data_chunk).decode()
+            if (self.recv_short_lines >= self.recv_shrink_after and
+                    self.recv_length <= self.recv_size):
+                self._resize_recv_buffer(self.recv_size)
 
-        except KeyboardInterrupt:
-            print('quitting server')
-            exit(1)
+        return True
+
+    def _resize_recv_buffer(self, size):
+        """
+        Replaces self.recv_buffer with one of `size` bytes, keeping the data
+        that has not been consumed yet.
+
+        :param size: int
+        :return: None
+        """
+        buffer = bytearray(size)
+        buffer[:self.recv_length] = self.recv_view[:self.recv_length]
+        self.recv_view.release()
+        self.recv_buffer = buffer
+        self.recv_view = memoryview(buffer)
+        self.recv_short_lines = 0
 
     def move(self, argument):
         """
@@ -157,41 +352,22 @@ class Server():
         :param argument: str
         :return: None
         """
-        available_moves = {
-            0: ['west', 'east', 'north'],
-            1: ['east'],
-            2: ['west'],
-            3: ['south']
-        }
-
-        argument = argument.lower().strip('\n')
-        print("move requested: {}".format(argument))
-
-        if self.room == 0 and argument in available_moves[self.room]:
-            print('in room 0')
-            if argument == 'west':
-                print('moving {}'.format(argument))
-                self.room = 1
-            elif argument == 'east':
-                print('moving {}'.format(argument))
-                self.room = 2
-            elif argument == 'north':
-                print('moving {}'.format(argument))
-                self.room = 3
-            elif argument == 'south':
-                print('moving {}'.format(argument))
-            else:
-                print('unexpected direction {}. staying in room {}'
-                      .format(argument, self.room))
-
-            self.output_buffer = self.room_description(self.room)
-        elif self.room in (1, 2, 3) and argument in available_moves[self.room]:
-            print('in room {}'.format(self.room))
-            print('moving to {}'.format(argument))
-            self.room = 0
-            self.output_buffer = self.room_description(self.room)
+        argument = argument.lower()
+        direction = _DIRECTIONS.get(argument)
+        if direction is None:
+            room = _NO_EXIT
         else:
+            room = _EXITS[self.room << 2 | direction]
+        log.debug("move requested: %s, from room %s to %s",
+                  argument, self.room, room)
+
+        if room == _NO_EXIT:
             self.output_buffer = "Oops! You can't go that way"
+            self.output_bytes = self._BAD_MOVE
+        else:
+            self.room = room
+            self.output_buffer = self.room_description(room)
+            self.output_bytes = self._ROOM_BYTES[room]
 
     def say(self, argument):
         """
@@ -207,13 +383,18 @@ class Server():
         :param argument: str
         :return: None
         """
-        print('Say message recieved')
-        self.output_buffer = "\nYou say, \"{}\"".format(argument.strip('\n'))
+        log.debug('Say message recieved')
+        argument = argument.strip('\n')
+        self.output_buffer = "\nYou say, \"{}\"".format(argument)
+        self.output_bytes = (
+            b'\nOK! You say, "' + argument.encode('utf-8') + b'"\n')
 
     def invalid_command(self, message):
         """ Deal with an unexpected command type """
-        print('Invalid command recieved')
-        self.output_buffer = "\nError: {}".format(message.strip('\n'))
+        log.debug('Invalid command recieved')
+        message = message.strip('\n')
+        self.output_buffer = "\nError: {}".format(message)
+        self.output_bytes = b'\nOK! Error: ' + message.encode('utf-8') + b'\n'
 
     def quit(self, message='Exit requested by user'):
         """
@@ -226,8 +407,9 @@ class Server():
         :param argument: str
         :return: None
         """
-        print('Goodbye! : {}'.format(message))
+        log.debug('Goodbye! : %s', message)
         self.output_buffer = "\nGoodbye!"
+        self.output_bytes = self._GOODBYE
         self.done = True
 
     def route(self):
@@ -242,23 +424,14 @@ class Server():
 
         :return: None
         """
-        command, message = ['', '']
+        command, _, argument = self.input_buffer.strip().partition(' ')
+        handler = self._DISPATCH.get(command)
+        self.output_bytes = None
 
-        if "quit" in self.input_buffer:
-            command, message = ["quit", 'Requested by user']
-        elif "say" in self.input_buffer:
-            command, message = self.input_buffer.split(' ', 1)
-        elif "move" in self.input_buffer:
-            command, message = self.input_buffer.split(' ', 2)
+        if handler is None:
+            self.invalid_command('you input an invalid command')
         else:
-            command, message = ['error', 'you input an invalid command']
-
-        {
-            "move": self.move,
-            "say": self.say,
-            "quit": self.quit,
-            "error": self.invalid_command
-        }[command](message)
+            handler(self, argument)
 
     def push_output(self):
         """
@@ -267,22 +440,198 @@ class Server():
         This method should prepend "OK! " to the output and append "\n" before
         sending it.
 
+        The reply is queued on self.pending_output and written by the next
+        `flush_output`, so that the replies to all the lines received together
+        go out in a single system call.
+
         :return: None
         """
-        self.output_buffer = "\nOK! {}\n".format(self.output_buffer
-                                                 .strip('\n'))
-        self.client_connection.sendall(self.output_buffer.encode('utf-8'))
+        reply = self.output_bytes
+        if reply is None:
+            reply = "\nOK! {}\n".format(
+                self.output_buffer.strip('\n')).encode('utf-8')
 
-    def serve(self):
-        """ Start the server listening """
-        self.connect()
-        self.greet()
-        self.push_output()
+        self.output_bytes = None
+        self.pending_output.append(reply)
+
+        # Write a long queue early, unless the client is already behind on
+        # reading: then the socket is full and only EVENT_WRITE can help
+        if (len(self.pending_output) >= self.max_pending_output and
+                not self._awaiting_write()):
+            self.flush_output()
+
+    def _awaiting_write(self):
+        """
+        :return: bool, True while the connection is watched for writability
+            because earlier replies could not all be sent
+        """
+        key = self.selector.get_key(self.client_connection)
+        return bool(key.events & selectors.EVENT_WRITE)
 
-        while not self.done:
-            self.get_input()
-            self.route()
+    def flush_output(self):
+        """
+        Writes the queued replies in self.pending_output to the client, up to
+        max_pending_output of them per scatter/gather `sendmsg` (well within
+        the kernel's iovec limit), for as long as the socket accepts data.
+
+        Whatever could not be written yet stays queued, and the connection is
+        watched for writability instead of input until it has drained. So a
+        client that stops reading its replies is not read from either: its
+        queue grows only by the replies to lines it had already sent.
+
+        :return: None
+        """
+        pending = self.pending_output
+        try:
+            while pending:
+                batch = pending[:self.max_pending_output]
+                sent = self.client_connection.sendmsg(batch)
+
+                # Drop what was written; keep the unsent tail of a partial
+                # write
+                written = 0
+                for reply in batch:
+                    if sent < len(reply):
+                        break
+                    sent -= len(reply)
+                    written += 1
+
+                del pending[:written]
+                if sent:
+                    pending[0] = pending[0][sent:]
+
+        except BlockingIOError:
+            pass
+
+        events = selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+        if self.selector.get_key(self.client_connection).events != events:
+            self.selector.modify(
+                self.client_connection, events, self.handle_events)
+
+    def start(self):
+        """
+        Begin the game with a newly connected client: register their
+        connection with the selector and greet them.
+
+        :return: None
+        """
+        self.selector.register(
+            self.client_connection, selectors.EVENT_READ, self.handle_events)
+        try:
+            self.greet()
             self.push_output()
+            self.flush_output()
+
+        except OSError as error:
+            # Gone before the greeting could be sent
+            log.debug('lost client: %s', error)
+            self.close()
+
+    def handle_events(self, events):
+        """
+        Called by the event loop when the client's connection is ready.
+
+        Reads everything available, acts on every complete line in turn, and
+        then sends all of the replies together.
+
+        :param events: int, the selectors.EVENT_* flags that are ready
+        :return: None
+        """
+        try:
+            if events & selectors.EVENT_READ:
+                connected = self.receive()
+
+                while not self.done and self.get_input():
+                    self.route()
+                    self.push_output()
+
+                if not connected:
+                    self.done = True
+
+            self.flush_output()
+
+        except OSError as error:
+            # Reset or broken pipe: the client is gone, so is their game
+            log.debug('lost client: %s', error)
+            self.done = True
+            self.pending_output.clear()
 
+        if self.done and not self.pending_output:
+            self.close()
+
+    def close(self):
+        """ Stop watching the client's connection and close it """
+        self.selector.unregister(self.client_connection)
         self.client_connection.close()
-        self.socket.close()
+
+        if self.listener is not None:
+            self.listener.resume_accepting()
+
+    def accept_clients(self, events):
+        """
+        Called by the event loop when the listening socket is ready: starts a
+        game for every client waiting to connect.
+
+        :param events: int, the selectors.EVENT_* flags that are ready
+        :return: None
+        """
+        while True:
+            try:
+                session = self.accept()
+            except BlockingIOError:
+                return
+            except OSError as error:
+                if error.errno in _ACCEPT_EXHAUSTED:
+                    # The waiting client stays queued, so the socket would
+                    # report ready again at once: stop watching it until a
+                    # session closes and frees a descriptor
+                    log.warning('not accepting clients for now: %s', error)
+                    self.selector.unregister(self.socket)
+                    return
+
+                # Only this client's connection failed; try the next one
+                log.warning('could not accept a client: %s', error)
+                continue
+
+            session.start()
+
+    def resume_accepting(self):
+        """
+        Watch the listening socket again if `accept_clients` had stopped
+        because the process ran out of resources.
+
+        :return: None
+        """
+        try:
+            self.selector.get_key(self.socket)
+        except KeyError:
+            log.warning('accepting clients again')
+            self.selector.register(
+                self.socket, selectors.EVENT_READ, self.accept_clients)
+
+    def serve(self):
+        """ Start the server listening and run the game for every client """
+        self.connect()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(
+            self.socket, selectors.EVENT_READ, self.accept_clients)
+
+        try:
+            while True:
+                for key, events in self.selector.select():
+                    key.data(events)
+
+        except KeyboardInterrupt:
+            log.info('quitting server')
+
+        finally:
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+
+    # Command word -> handler, consulted by `route`
+    _DISPATCH = {
+        "move": move,
+        "say": say,
+        "quit": quit
+    }